@@ -1,12 +1,21 @@
 import os
-import json
 import sqlite3
 import uuid
-from pathlib import Path
+import hashlib
+import asyncio
+import itertools
+import bisect
+from concurrent.futures import ProcessPoolExecutor
+import aiohttp
+import ijson
+import tiktoken
 from dotenv import load_dotenv
-from openai import OpenAI
 from bs4 import BeautifulSoup
 import logging
+import numpy as np
+from quantization import quantize_embedding
+from snippet import SNIPPET_CHARS
+from http_retry import RETRYABLE_STATUSES, retry_delay
 
 # === Logging Setup ===
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
@@ -16,29 +25,176 @@ logger = logging.getLogger(__name__)
 FORUM_DIR = "downloaded_threads"
 COURSE_DIR = "markdown_files"
 DB_PATH = "knowledge_base.db"
-CHUNK_SIZE = 750
-CHUNK_OVERLAP = 70
+EMBED_CACHE_PATH = "embeddings_cache.sqlite"
+EMBEDDING_MODEL = "text-embedding-3-small"
+CHUNK_TOKENS = 512
+CHUNK_STRIDE = 384
+# Chunk edges move to a line break within this many tokens; ends only move
+# backwards, so no chunk exceeds CHUNK_TOKENS
+NEWLINE_SNAP_TOKENS = 32
+# 256 chunks of <=512 tokens is <=131k tokens, well within the per-request limit
+EMBED_BATCH_SIZE = 256
+MAX_CONCURRENT_EMBED_REQUESTS = 8
+EMBED_MAX_RETRIES = 6
 
 load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_KEY"))
+OPENAI_KEY = os.getenv("OPENAI_KEY")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
+
+encoding = tiktoken.encoding_for_model(EMBEDDING_MODEL)
+
+def snap_to_newline(position, line_breaks, before=NEWLINE_SNAP_TOKENS, after=NEWLINE_SNAP_TOKENS):
+    """Move a token position to the closest line break in [position - before, position + after], if any."""
+    i = bisect.bisect_left(line_breaks, position - before)
+    candidates = line_breaks[i:bisect.bisect_right(line_breaks, position + after)]
+    return min(candidates, key=lambda b: abs(b - position)) if candidates else position
+
+def chunk_text(text, chunk_tokens=CHUNK_TOKENS, stride=CHUNK_STRIDE):
+    """Slide a token window over `text`, snapping chunk edges to line breaks where possible."""
+    tokens = encoding.encode(text)
+    # Token offsets that start a new line
+    line_breaks = [
+        i + 1 for i, token in enumerate(tokens)
+        if b"\n" in encoding.decode_single_token_bytes(token)
+    ]
 
-def chunk_text(text, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
     chunks, start = [], 0
-    while start < len(text):
-        end = start + chunk_size
-        chunk = text[start:end].strip()
+    while start < len(tokens):
+        end = start + chunk_tokens
+        if end < len(tokens):
+            end = snap_to_newline(end, line_breaks, after=0)
+        # Window edges can fall inside a multibyte character; the source text is valid
+        # UTF-8, so only those cut-off edge bytes are dropped here. Windows overlap,
+        # so each such character is kept whole in the neighbouring chunk.
+        chunk = encoding.decode_bytes(tokens[start:end]).decode("utf-8", errors="ignore").strip()
         if chunk:
             chunks.append(chunk)
-        start += chunk_size - overlap
+        if end >= len(tokens):
+            break
+        next_start = snap_to_newline(start + stride, line_breaks)
+        start = next_start if start < next_start < end else start + stride
     return chunks
 
-def embed(texts):
-    response = client.embeddings.create(model="text-embedding-3-small", input=texts)
-    return [item.embedding for item in response.data]
+async def embed(session, texts):
+    payload = {"model": EMBEDDING_MODEL, "input": texts}
+    for attempt in range(EMBED_MAX_RETRIES + 1):
+        try:
+            async with session.post(f"{OPENAI_BASE_URL}/embeddings", json=payload) as resp:
+                if resp.status == 200:
+                    result = await resp.json()
+                    break
+                if resp.status not in RETRYABLE_STATUSES or attempt == EMBED_MAX_RETRIES:
+                    raise RuntimeError(f"Embedding request failed ({resp.status}): {await resp.text()}")
+                reason, delay = resp.status, retry_delay(attempt, resp.headers.get("Retry-After"))
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            if attempt == EMBED_MAX_RETRIES:
+                raise
+            reason, delay = repr(e), retry_delay(attempt)
+        logger.warning(f"⏳ Embedding request failed ({reason}), retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
+    return [item["embedding"] for item in sorted(result["data"], key=lambda item: item["index"])]
+
+def open_embedding_cache():
+    """Content-hash → float32 embedding store that survives knowledge base rebuilds."""
+    cache = sqlite3.connect(EMBED_CACHE_PATH)
+    cache.execute("CREATE TABLE IF NOT EXISTS embeddings (hash TEXT PRIMARY KEY, embedding BLOB)")
+    return cache
+
+def content_hash(text):
+    return hashlib.sha256((text + EMBEDDING_MODEL).encode("utf-8")).hexdigest()
+
+class BatchEmbedder:
+    """Buffers chunks per table and embeds them in concurrent batched API calls.
+
+    Full batches are embedded in background tasks (at most
+    MAX_CONCURRENT_EMBED_REQUESTS in flight); finished batches go through a
+    queue to a single writer task, the only code touching SQLite.
+    """
+
+    def __init__(self, conn, cache, session, batch_size=EMBED_BATCH_SIZE):
+        self.conn = conn
+        self.cache = cache
+        self.session = session
+        self.batch_size = batch_size
+        self.semaphore = asyncio.Semaphore(MAX_CONCURRENT_EMBED_REQUESTS)
+        self.queue = asyncio.Queue()
+        self.buffers = {}
+        self.pending = []
+        self.totals = {}
+        self.cache_hits = 0
+        self.writer = asyncio.create_task(self.write_batches())
+
+    def add(self, table, chunk, metadata):
+        """Queue a chunk; `metadata` is the row tuple minus the text, snippet and embedding columns."""
+        texts, rows = self.buffers.setdefault(table, ([], []))
+        texts.append(chunk)
+        rows.append(metadata)
+        if len(texts) >= self.batch_size:
+            self.flush(table)
+
+    def lookup_cached(self, hashes):
+        placeholders = ", ".join("?" * len(hashes))
+        cursor = self.cache.execute(
+            f"SELECT hash, embedding FROM embeddings WHERE hash IN ({placeholders})", hashes
+        )
+        return dict(cursor.fetchall())
+
+    def flush(self, table):
+        texts, rows = self.buffers.pop(table, ([], []))
+        if not texts:
+            return
+        hashes = [content_hash(chunk) for chunk in texts]
+        blobs = self.lookup_cached(list(set(hashes)))
+        self.cache_hits += sum(h in blobs for h in hashes)
+        self.pending.append(asyncio.create_task(self.embed_batch(table, texts, rows, hashes, blobs)))
+
+    async def embed_batch(self, table, texts, metadata, hashes, blobs):
+        misses = {h: chunk for h, chunk in zip(hashes, texts) if h not in blobs}
+        new_blobs = {}
+        if misses:
+            async with self.semaphore:
+                embeddings = await embed(self.session, list(misses.values()))
+            new_blobs = {
+                h: np.asarray(emb, dtype=np.float32).tobytes()
+                for h, emb in zip(misses, embeddings)
+            }
+            blobs.update(new_blobs)
+
+        rows = [
+            (*meta, chunk, chunk[:SNIPPET_CHARS], *quantize_embedding(np.frombuffer(blobs[h], dtype=np.float32)))
+            for meta, chunk, h in zip(metadata, texts, hashes)
+        ]
+        await self.queue.put((table, rows, new_blobs))
+
+    async def write_batches(self):
+        while (item := await self.queue.get()) is not None:
+            table, rows, new_blobs = item
+            if new_blobs:
+                self.cache.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?)", new_blobs.items())
+                self.cache.commit()
+            placeholders = ", ".join("?" * len(rows[0]))
+            self.conn.executemany(f"INSERT INTO {table} VALUES ({placeholders})", rows)
+            self.totals[table] = self.totals.get(table, 0) + len(rows)
+            logger.info(f"🧠 Inserted {len(rows)} chunks into {table} ({len(new_blobs)} newly embedded)")
+
+    async def close(self):
+        """Flush partial batches and wait until every row has been written."""
+        for table in list(self.buffers):
+            self.flush(table)
+        try:
+            await asyncio.gather(*self.pending)
+        finally:
+            await self.queue.put(None)
+            await self.writer
 
 def create_db():
-    conn = sqlite3.connect(DB_PATH)
+    # Autocommit mode so the whole rebuild, schema included, runs in one explicit
+    # transaction; a failed load rolls back to the previous knowledge base
+    conn = sqlite3.connect(DB_PATH, isolation_level=None)
     cur = conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("BEGIN")
     cur.execute("DROP TABLE IF EXISTS forum_chunks")
     cur.execute("DROP TABLE IF EXISTS course_chunks")
     cur.execute('''
@@ -51,7 +207,9 @@ def create_db():
             author TEXT,
             url TEXT,
             text TEXT,
-            embedding BLOB
+            snippet TEXT,
+            embedding BLOB,
+            embedding_scale REAL
         )
     ''')
     cur.execute('''
@@ -61,27 +219,22 @@ def create_db():
             section_title TEXT,
             url TEXT,
             text TEXT,
-            embedding BLOB
+            snippet TEXT,
+            embedding BLOB,
+            embedding_scale REAL
         )
     ''')
-    conn.commit()
     return conn
 
-def process_forum_json(filepath, conn):
+def chunk_forum_json(filepath):
+    """Chunk a forum topic dump into (table, chunk, metadata) rows."""
     logger.info(f"📁 Processing forum JSON file: {filepath}")
-    with open(filepath, 'r', encoding='utf-8') as f:
-        posts = json.load(f)
-
-    count = 0
-    for post in posts:
-        chunks = chunk_text(post["content"])
-        if not chunks:
-            continue
-        embeddings = embed(chunks)
-        for chunk, emb in zip(chunks, embeddings):
-            conn.execute(
-                '''INSERT INTO forum_chunks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                (
+    rows = []
+    # Stream posts out of the topic dump instead of loading it whole
+    with open(filepath, 'rb') as f:
+        for post in ijson.items(f, 'item'):
+            for chunk in chunk_text(post["content"]):
+                rows.append(("forum_chunks", chunk, (
                     str(uuid.uuid4()),
                     post["post_id"],
                     post["post_number"],
@@ -89,89 +242,96 @@ def process_forum_json(filepath, conn):
                     post["topic_title"],
                     post["author"],
                     f"https://discourse.onlinedegree.iitm.ac.in/t/{post['topic_id']}/{post['post_number']}",
-                    chunk,
-                    json.dumps(emb)
-                )
-            )
-            count += 1
-    logger.info(f"✅ Inserted {count} chunks from {filepath}")
-
-def process_course_md(filepath, conn):
-    logger.info(f"📁 Processing course file: {filepath}")
-    content = Path(filepath).read_text(encoding='utf-8')
-    lines = content.splitlines()
+                )))
+    logger.info(f"✅ Chunked {len(rows)} chunks from {filepath}")
+    return rows
 
+def iter_md_sections(filepath):
+    """Stream a course markdown file, yielding (original_url, section_title, text) per section."""
     url = None
-    if lines and lines[0].strip() == "---":
-        for i in range(1, len(lines)):
-            if lines[i].strip().startswith("original_url:"):
-                url = lines[i].split(":", 1)[1].strip().strip('"')
-            elif lines[i].strip() == "---":
-                lines = lines[i+1:]
-                break
-
     section_title = ""
-    buffer = ""
-    count = 0
-    for line in lines:
-        if line.strip().startswith("#"):
-            if buffer.strip():
-                chunks = chunk_text(buffer)
-                embeddings = embed(chunks)
-                for chunk, emb in zip(chunks, embeddings):
-                    conn.execute(
-                        '''INSERT INTO course_chunks VALUES (?, ?, ?, ?, ?, ?)''',
-                        (
-                            str(uuid.uuid4()),
-                            os.path.basename(filepath),
-                            section_title,
-                            url,
-                            chunk,
-                            json.dumps(emb)
-                        )
-                    )
-                    count += 1
-                buffer = ""
-            section_title = line.strip("# ").strip()
-        else:
-            buffer += line + "\n"
-
-    if buffer.strip():
-        chunks = chunk_text(buffer)
-        embeddings = embed(chunks)
-        for chunk, emb in zip(chunks, embeddings):
-            conn.execute(
-                '''INSERT INTO course_chunks VALUES (?, ?, ?, ?, ?, ?)''',
-                (
-                    str(uuid.uuid4()),
-                    os.path.basename(filepath),
-                    section_title,
-                    url,
-                    chunk,
-                    json.dumps(emb)
-                )
-            )
-            count += 1
+    buffer_parts = []
+    with open(filepath, 'r', encoding='utf-8') as f:
+        lines = (line.rstrip("\n") for line in f)
+        first = next(lines, None)
+        if first is not None and first.strip() == "---":
+            front_matter = [first]
+            for line in lines:
+                front_matter.append(line)
+                if line.strip().startswith("original_url:"):
+                    url = line.split(":", 1)[1].strip().strip('"')
+                elif line.strip() == "---":
+                    break
+            else:
+                # Unclosed front matter: keep its lines as ordinary content
+                lines = iter(front_matter)
+        elif first is not None:
+            lines = itertools.chain([first], lines)
 
-    logger.info(f"✅ Inserted {count} chunks from {filepath}")
+        for line in lines:
+            if line.strip().startswith("#"):
+                text = "\n".join(buffer_parts)
+                if text.strip():
+                    yield url, section_title, text
+                buffer_parts = []
+                section_title = line.strip("# ").strip()
+            else:
+                buffer_parts.append(line)
 
-def main():
+    text = "\n".join(buffer_parts)
+    if text.strip():
+        yield url, section_title, text
+
+def chunk_course_md(filepath):
+    """Chunk a course markdown file into (table, chunk, metadata) rows."""
+    logger.info(f"📁 Processing course file: {filepath}")
+    source_file = os.path.basename(filepath)
+    rows = []
+    for url, section_title, text in iter_md_sections(filepath):
+        for chunk in chunk_text(text):
+            rows.append(("course_chunks", chunk, (str(uuid.uuid4()), source_file, section_title, url)))
+
+    logger.info(f"✅ Chunked {len(rows)} chunks from {filepath}")
+    return rows
+
+def chunk_file(filepath):
+    """Worker entry point: chunk one forum JSON or course markdown file."""
+    if filepath.endswith(".json"):
+        return chunk_forum_json(filepath)
+    return chunk_course_md(filepath)
+
+async def main_async():
     conn = create_db()
+    cache = open_embedding_cache()
+    headers = {"Authorization": f"Bearer {OPENAI_KEY}"}
 
-    logger.info("🔎 Processing forum JSON files...")
-    for file in os.listdir(FORUM_DIR):
-        if file.endswith(".json"):
-            process_forum_json(os.path.join(FORUM_DIR, file), conn)
+    async with aiohttp.ClientSession(headers=headers) as session:
+        embedder = BatchEmbedder(conn, cache, session)
+        try:
+            paths = [os.path.join(FORUM_DIR, file) for file in os.listdir(FORUM_DIR) if file.endswith(".json")]
+            paths += [os.path.join(COURSE_DIR, file) for file in os.listdir(COURSE_DIR) if file.endswith(".md")]
+            logger.info(f"🔎 Chunking {len(paths)} forum and course files...")
 
-    logger.info("🔎 Processing course markdown files...")
-    for file in os.listdir(COURSE_DIR):
-        if file.endswith(".md"):
-            process_course_md(os.path.join(COURSE_DIR, file), conn)
+            # Chunking is CPU-bound, so it runs across processes; this process only embeds and writes
+            loop = asyncio.get_running_loop()
+            with ProcessPoolExecutor() as pool:
+                futures = [loop.run_in_executor(pool, chunk_file, path) for path in paths]
+                for future in asyncio.as_completed(futures):
+                    for table, chunk, metadata in await future:
+                        embedder.add(table, chunk, metadata)
+        finally:
+            await embedder.close()
 
     conn.commit()
     conn.close()
+    cache.close()
+    logger.info(f"📊 {embedder.totals.get('forum_chunks', 0)} forum chunks, {embedder.totals.get('course_chunks', 0)} course chunks")
+    logger.info(f"♻️ {embedder.cache_hits} embeddings reused from {EMBED_CACHE_PATH}")
     logger.info(f"🎉 Knowledge base rebuilt and stored in {DB_PATH}")
 
+def main():
+    asyncio.run(main_async())
+
 if __name__ == "__main__":
     main()
 
@@ -1,9 +1,12 @@
 import os
 import json
+import asyncio
+import aiohttp
 import requests
 from datetime import datetime, timezone
 from urllib.parse import urljoin, urlencode
 from playwright.sync_api import sync_playwright
+from http_retry import RETRYABLE_STATUSES, retry_delay
 
 # Auth & Config.
 
@@ -15,6 +18,8 @@ END_DATE = "2025-04-15"    # Inclusive
 OUTPUT_DIR = "discourse_json"
 AUTH_STATE_FILE = "auth.json"
 POST_ID_BATCH_SIZE = 50
+MAX_CONCURRENT_REQUESTS = 10
+MAX_RETRIES = 6
 MAX_CONSECUTIVE_PAGES_WITHOUT_NEW_TOPICS = 5
 
 # Login in case of absence of auth.json.
@@ -46,6 +51,7 @@ def load_cookies_from_playwright():
 def get_topic_ids(base_url, category_slug, category_id, start_date_str, end_date_str, cookies):
     url = urljoin(base_url, f"c/{category_slug}/{category_id}.json")
     topic_ids = []
+    seen = set()
     page = 0
 
     start_dt_naive = datetime.fromisoformat(start_date_str + "T00:00:00")
@@ -79,7 +85,7 @@ def get_topic_ids(base_url, category_slug, category_id, start_date_str, end_date
             print(f"No more topics on page {page}.")
             break
 
-        count_before = len(set(topic_ids))
+        count_before = len(seen)
 
         for topic in topics_on_page:
             created_at_str = topic.get("created_at")
@@ -89,10 +95,11 @@ def get_topic_ids(base_url, category_slug, category_id, start_date_str, end_date
                 except ValueError:
                     continue
 
-                if start_dt <= created_date <= end_dt:
+                if start_dt <= created_date <= end_dt and topic["id"] not in seen:
+                    seen.add(topic["id"])
                     topic_ids.append(topic["id"])
 
-        current_count = len(set(topic_ids))
+        current_count = len(seen)
 
         if current_count == count_before:
             consecutive_pages_with_no_new_unique_topics += 1
@@ -113,16 +120,47 @@ def get_topic_ids(base_url, category_slug, category_id, start_date_str, end_date
         print(f"Page {page} OK. Continuing...")
         page += 1
 
-    return list(set(topic_ids))
+    return topic_ids
+
+async def fetch_json(session, semaphore, url, params=None):
+    """GET a JSON document, holding one of the shared concurrency slots.
+
+    Rate-limited (429) and transient 5xx responses are retried; the slot is
+    released while waiting so other requests can proceed.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        async with semaphore:
+            async with session.get(url, params=params) as response:
+                if response.status not in RETRYABLE_STATUSES or attempt == MAX_RETRIES:
+                    response.raise_for_status()
+                    return await response.json()
+                delay = retry_delay(attempt, response.headers.get("Retry-After"))
+        print(f"Got {response.status} for {url}, retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+async def fetch_post_batch(session, semaphore, posts_url, topic_id, batch_ids):
+    """Fetch one batch of posts; returns None if the batch could not be fetched."""
+    query = [("post_ids[]", pid) for pid in batch_ids]
+    try:
+        batch_data = await fetch_json(session, semaphore, posts_url, params=query)
+    except Exception as e:
+        print(f"Error fetching post batch for topic {topic_id}: {e}")
+        return None
 
-def get_full_topic_json(base_url, topic_id, cookies):
+    if isinstance(batch_data, list):
+        return batch_data
+    elif "post_stream" in batch_data and "posts" in batch_data["post_stream"]:
+        return batch_data["post_stream"]["posts"]
+    elif "posts" in batch_data:
+        return batch_data["posts"]
+    return []
+
+async def get_full_topic_json(session, semaphore, base_url, topic_id):
     topic_url = urljoin(base_url, f"t/{topic_id}.json")
     print(f"Fetching topic {topic_id}")
 
     try:
-        response = requests.get(topic_url, cookies=cookies, timeout=30)
-        response.raise_for_status()
-        topic_data = response.json()
+        topic_data = await fetch_json(session, semaphore, topic_url)
     except Exception as e:
         print(f"Failed to fetch topic {topic_id}: {e}")
         return None
@@ -135,24 +173,16 @@ def get_full_topic_json(base_url, topic_id, cookies):
     loaded_ids = {post["id"] for post in post_stream.get("posts", [])}
     missing_ids = [pid for pid in all_ids if pid not in loaded_ids]
 
-    fetched_posts = []
-    for i in range(0, len(missing_ids), POST_ID_BATCH_SIZE):
-        batch_ids = missing_ids[i:i + POST_ID_BATCH_SIZE]
-        query = [("post_ids[]", pid) for pid in batch_ids]
-        posts_url = urljoin(base_url, f"t/{topic_id}/posts.json")
-
-        try:
-            batch_response = requests.get(posts_url, params=query, cookies=cookies, timeout=30)
-            batch_response.raise_for_status()
-            batch_data = batch_response.json()
-            if isinstance(batch_data, list):
-                fetched_posts.extend(batch_data)
-            elif "post_stream" in batch_data and "posts" in batch_data["post_stream"]:
-                fetched_posts.extend(batch_data["post_stream"]["posts"])
-            elif "posts" in batch_data:
-                fetched_posts.extend(batch_data["posts"])
-        except Exception as e:
-            print(f"Error fetching post batch for topic {topic_id}: {e}")
+    posts_url = urljoin(base_url, f"t/{topic_id}/posts.json")
+    batches = await asyncio.gather(*[
+        fetch_post_batch(session, semaphore, posts_url, topic_id, missing_ids[i:i + POST_ID_BATCH_SIZE])
+        for i in range(0, len(missing_ids), POST_ID_BATCH_SIZE)
+    ])
+    if any(batch is None for batch in batches):
+        # Saving the topic now would silently drop posts, so report it as failed
+        print(f"Failed to fetch all posts for topic {topic_id}")
+        return None
+    fetched_posts = [post for batch in batches for post in batch]
 
     if fetched_posts:
         existing = {p['id']: p for p in topic_data["post_stream"]["posts"]}
@@ -175,6 +205,28 @@ def save_topic_json(topic_id, data, output_dir):
     except IOError as e:
         print(f"Error saving topic {topic_id}: {e}")
 
+async def download_topics(topic_ids, cookies):
+    """Fetch and save all topics concurrently; returns (success count, failed IDs)."""
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    timeout = aiohttp.ClientTimeout(total=30)
+    successes = 0
+    failed = []
+
+    async with aiohttp.ClientSession(cookies=cookies, timeout=timeout) as session:
+        async def download(tid):
+            nonlocal successes
+            data = await get_full_topic_json(session, semaphore, DISCOURSE_BASE_URL, tid)
+            if data:
+                save_topic_json(tid, data, OUTPUT_DIR)
+                successes += 1
+                print(f" [{successes + len(failed)}/{len(topic_ids)}] Saved topic {tid}")
+            else:
+                failed.append(tid)
+
+        await asyncio.gather(*[download(tid) for tid in topic_ids])
+
+    return successes, failed
+
 def main():
     print("Starting Discourse Downloader")
     cookies = load_cookies_from_playwright()
@@ -193,17 +245,7 @@ def main():
         return
 
     print(f"\n Downloading {len(topic_ids)} topics...\n")
-    successes = 0
-    failed = []
-
-    for i, tid in enumerate(topic_ids, 1):
-        print(f"\n [{i}/{len(topic_ids)}] Topic ID: {tid}")
-        data = get_full_topic_json(DISCOURSE_BASE_URL, tid, cookies)
-        if data:
-            save_topic_json(tid, data, OUTPUT_DIR)
-            successes += 1
-        else:
-            failed.append(tid)
+    successes, failed = asyncio.run(download_topics(topic_ids, cookies))
 
     print("\n DONE")
     print(f"Downloaded: {successes}")
@@ -0,0 +1,14 @@
+import random
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+MAX_RETRY_DELAY = 60
+
+def retry_delay(attempt, retry_after=None):
+    """Seconds to wait before retrying: the server's Retry-After if given, else exponential backoff.
+
+    Both are capped at MAX_RETRY_DELAY so one response cannot stall a request slot for long.
+    """
+    try:
+        return min(float(retry_after), MAX_RETRY_DELAY)
+    except (TypeError, ValueError):
+        return min(2 ** attempt, MAX_RETRY_DELAY) + random.random()
@@ -0,0 +1,54 @@
+import sqlite3
+import json
+import numpy as np
+from quantization import quantize_embedding
+from snippet import SNIPPET_CHARS
+
+DB_PATH = "knowledge_base.db"
+TABLES = ["forum_chunks", "course_chunks"]
+EMBEDDING_DIM = 1536
+
+def migrate_table(cursor, table):
+    columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({table})")]
+    if "embedding_scale" not in columns:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN embedding_scale REAL")
+    if "snippet" not in columns:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN snippet TEXT")
+    cursor.execute(f"UPDATE {table} SET snippet = substr(text, 1, ?) WHERE snippet IS NULL", (SNIPPET_CHARS,))
+
+    cursor.execute(f"SELECT chunk_id, embedding, embedding_scale FROM {table}")
+    rows = cursor.fetchall()
+
+    updates = []
+    for chunk_id, emb, scale in rows:
+        # Rows already stored as int8 with a scale are left untouched
+        if scale is not None:
+            continue
+        if isinstance(emb, str):
+            vector = json.loads(emb)
+        elif len(emb) == EMBEDDING_DIM * 4:
+            vector = np.frombuffer(emb, dtype=np.float32)
+        else:
+            print(f"❌ Skipping {table} row {chunk_id}: unrecognised embedding format")
+            continue
+        updates.append((*quantize_embedding(vector), chunk_id))
+
+    cursor.executemany(
+        f"UPDATE {table} SET embedding = ?, embedding_scale = ? WHERE chunk_id = ?", updates
+    )
+    print(f"✅ {table}: converted {len(updates)} of {len(rows)} embeddings to int8 blobs")
+
+def migrate_embeddings():
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+
+    for table in TABLES:
+        migrate_table(cursor, table)
+
+    conn.commit()
+    conn.execute("VACUUM")
+    conn.close()
+    print("🔁 Embedding migration complete.")
+
+if __name__ == "__main__":
+    migrate_embeddings()
@@ -0,0 +1,20 @@
+import base64
+import logging
+from io import BytesIO
+from PIL import Image
+import pytesseract
+
+# Runs inside the API's OCR worker processes, so it only imports what OCR needs
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+logger = logging.getLogger("uvicorn.error")
+
+def extract_text_from_base64_image(image_base64: str) -> str:
+    try:
+        image_data = base64.b64decode(image_base64)
+        image = Image.open(BytesIO(image_data))
+        text = pytesseract.image_to_string(image).strip()
+        logger.info(f"OCR extracted text: '{text[:80]}...' ({len(text)} chars)")
+        return text
+    except Exception as e:
+        logger.warning(f"Failed to extract text from image: {e}")
+        return ""
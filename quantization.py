@@ -0,0 +1,8 @@
+import numpy as np
+
+def quantize_embedding(emb):
+    """L2-normalize and quantize to int8 with a per-vector scale; returns (int8 bytes, scale)."""
+    v = np.asarray(emb, dtype=np.float32)
+    v = v / (np.linalg.norm(v) or 1.0)
+    scale = float(np.abs(v).max()) / 127 or 1.0
+    return np.round(v / scale).astype(np.int8).tobytes(), scale
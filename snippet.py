@@ -0,0 +1,2 @@
+# Chunk text is cut to this length for the LLM prompt; the full text is kept alongside
+SNIPPET_CHARS = 1500
@@ -3,18 +3,23 @@ import json
 import sqlite3
 import logging
 import re
+import asyncio
+import glob
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import closing, suppress
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Optional
 from dotenv import load_dotenv
-import base64
-from io import BytesIO
-from PIL import Image
-import pytesseract
+from ocr import extract_text_from_base64_image
 from openai import OpenAI
 import numpy as np
 import aiohttp
+import hnswlib
 
 # === Logging Setup ===
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
@@ -27,13 +32,22 @@ if not API_KEY:
     raise RuntimeError("API_KEY  not set in .env")
 
 openai_client = OpenAI(api_key=API_KEY)
-conn = sqlite3.connect("knowledge_base.db")
+DB_PATH = "knowledge_base.db"
 
 app = FastAPI()
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
 
 SIMILARITY_THRESHOLD = 0.4
 MAX_RESULTS = 50
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIM = 1536
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 100
+SEMANTIC_CACHE_THRESHOLD = 0.95
+SEMANTIC_CACHE_MAX_ENTRIES = 10000
+CHUNK_TABLES = ["forum_chunks", "course_chunks"]
+POST_NUMBER_RE = re.compile(r"/(\d+)/*$")
 
 class QueryRequest(BaseModel):
     question: str
@@ -47,56 +61,279 @@ class QueryResponse(BaseModel):
     answer: str
     links: List[Link]
 
-def extract_text_from_base64_image(image_base64: str) -> str:
+# OCR is CPU-bound, so it runs in worker processes rather than on the event loop
+ocr_pool: Optional[ProcessPoolExecutor] = None
+
+def new_ocr_pool() -> ProcessPoolExecutor:
+    # Spawned rather than forked: by the time workers start, this process has
+    # event loop and executor threads that must not be copied into a child
+    return ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("spawn"))
+
+@app.on_event("startup")
+def start_ocr_pool():
+    global ocr_pool
+    ocr_pool = new_ocr_pool()
+
+@app.on_event("shutdown")
+def stop_ocr_pool():
+    ocr_pool.shutdown()
+
+async def run_ocr(image_base64: str) -> str:
+    global ocr_pool
+    pool = ocr_pool
+    loop = asyncio.get_running_loop()
     try:
-        image_data = base64.b64decode(image_base64)
-        image = Image.open(BytesIO(image_data))
-        text = pytesseract.image_to_string(image).strip()
-        logger.info(f"OCR extracted text: '{text[:80]}...' ({len(text)} chars)")
-        return text
-    except Exception as e:
-        logger.warning(f"Failed to extract text from image: {e}")
+        return await loop.run_in_executor(pool, extract_text_from_base64_image, image_base64)
+    except BrokenProcessPool as e:
+        # A worker died (e.g. OOM-killed); replace the pool once and carry on without OCR text
+        logger.warning(f"OCR worker pool broke, restarting it: {e}")
+        if pool is ocr_pool:
+            pool.shutdown(wait=False)
+            ocr_pool = new_ocr_pool()
         return ""
 
 def get_embedding(text: str) -> List[float]:
-    response = openai_client.embeddings.create(model="text-embedding-3-small", input=[text])
+    response = openai_client.embeddings.create(model=EMBEDDING_MODEL, input=[text])
     return response.data[0].embedding
 
-def cosine_similarity(a, b):
-    a, b = np.array(a), np.array(b)
-    return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
+def open_db() -> sqlite3.Connection:
+    """Read-only connection, only used while (re)loading the in-memory knowledge base."""
+    db = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    db.execute("PRAGMA query_only=ON")
+    return db
+
+def load_table_embeddings(db: sqlite3.Connection, table: str):
+    """Load a chunk table's int8 embeddings into an HNSW index plus parallel url/text/post-number lists."""
+    urls, texts, vectors, scales = [], [], [], []
+    # Identifies exactly which rows, in which order, back the HNSW labels
+    digest = hashlib.sha256()
+    # Only the prompt-sized snippet is needed in memory, not the full chunk text
+    cursor = db.execute(f"SELECT chunk_id, url, snippet, embedding, embedding_scale FROM {table} ORDER BY rowid")
+    for chunk_id, url, text, emb_blob, scale in cursor:
+        emb = np.frombuffer(emb_blob or b"", dtype=np.int8)
+        if len(emb) != EMBEDDING_DIM or scale is None:
+            logger.warning(f"Skipping {table} row with unexpected embedding format → {url}")
+            continue
+        digest.update(chunk_id.encode("utf-8"))
+        digest.update(emb_blob)
+        urls.append(url)
+        texts.append(text)
+        vectors.append(emb)
+        scales.append(scale)
+
+    # Rows are stored as normalized int8 vectors with a per-row scale
+    matrix = np.vstack(vectors) if vectors else np.empty((0, EMBEDDING_DIM), dtype=np.int8)
+    matrix = matrix.astype(np.float32) * np.asarray(scales, dtype=np.float32)[:, None]
+    # Forum URLs end in the post number, used to break similarity ties
+    post_numbers = np.array(
+        [int(m.group(1)) if (m := POST_NUMBER_RE.search(url or "")) else 0 for url in urls],
+        dtype=np.int64,
+    )
+    logger.info(f"Loaded {len(urls)} embeddings from {table}")
+    return {
+        "index": load_table_index(table, matrix, digest.hexdigest()),
+        "urls": urls,
+        "texts": texts,
+        "post_numbers": post_numbers,
+    }
 
-def retrieve_similar_chunks(question: str, top_k=MAX_RESULTS):
+def load_table_index(table: str, matrix: np.ndarray, digest: str) -> Optional[hnswlib.Index]:
+    """Return an HNSW index over `matrix`, reusing the one persisted for the same rows if present.
+
+    Index files are named after a digest of the rows they were built from, so
+    a file left over from another DB build is never picked up.
+    """
+    if not len(matrix):
+        return None
+    prefix = f"{os.path.splitext(DB_PATH)[0]}.{table}."
+    index_path = f"{prefix}{digest[:16]}.hnsw"
+    index = hnswlib.Index(space="cosine", dim=EMBEDDING_DIM)
+
+    if os.path.exists(index_path):
+        index.load_index(index_path, max_elements=len(matrix))
+        if index.get_current_count() == len(matrix):
+            logger.info(f"Loaded HNSW index for {table} from {index_path}")
+            index.set_ef(HNSW_EF_SEARCH)
+            return index
+        index = hnswlib.Index(space="cosine", dim=EMBEDDING_DIM)
+
+    logger.info(f"Building HNSW index for {table}...")
+    index.init_index(max_elements=len(matrix), ef_construction=HNSW_EF_CONSTRUCTION, M=HNSW_M)
+    index.add_items(matrix, np.arange(len(matrix)))
+    # Write to a temp file and swap it in, so a concurrent loader never reads a partial index
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    index.save_index(tmp_path)
+    os.replace(tmp_path, index_path)
+    for stale_path in glob.glob(f"{glob.escape(prefix)}*.hnsw"):
+        if stale_path != index_path:
+            with suppress(FileNotFoundError):
+                os.remove(stale_path)
+    index.set_ef(HNSW_EF_SEARCH)
+    return index
+
+# In-memory copy of the chunk tables and the DB version they were loaded from.
+# A reload builds a new dict and swaps it in, so a query never mixes two loads.
+knowledge_base = {"version": None, "tables": {}}
+knowledge_base_lock = asyncio.Lock()
+# (inode, connection) kept open only to poll PRAGMA data_version
+version_db = None
+
+def db_version() -> tuple:
+    """Identify the committed state of the DB.
+
+    PRAGMA data_version only changes once another connection commits, so an
+    ingestion run still writing its transaction to the -wal file is not seen
+    as a change. The inode catches the file being replaced outright.
+    """
+    global version_db
+    inode = os.stat(DB_PATH).st_ino
+    if version_db is None or version_db[0] != inode:
+        if version_db is not None:
+            version_db[1].close()
+        version_db = (inode, open_db())
+    return inode, version_db[1].execute("PRAGMA data_version").fetchone()[0]
+
+def load_knowledge_base(version: tuple):
+    global knowledge_base
+    with closing(open_db()) as db:
+        tables = {table: load_table_embeddings(db, table) for table in CHUNK_TABLES}
+    knowledge_base = {"version": version, "tables": tables}
+
+async def refresh_knowledge_base():
+    if db_version() == knowledge_base["version"]:
+        return
+    async with knowledge_base_lock:
+        # Another request may have finished the reload while this one waited
+        version = db_version()
+        if version != knowledge_base["version"]:
+            logger.info(f"{DB_PATH} changed on disk, reloading embeddings...")
+            # Reading every row and loading the HNSW index would block the event loop
+            await asyncio.to_thread(load_knowledge_base, version)
+
+@app.on_event("startup")
+def load_knowledge_base_on_startup():
+    load_knowledge_base(db_version())
+
+def embed_question(question: str) -> np.ndarray:
     logger.info(f"Embedding query text...")
-    question_embedding = get_embedding(question)
-
-    all_chunks = []
-    for table in ["forum_chunks", "course_chunks"]:
+    q = np.asarray(get_embedding(question), dtype=np.float32)
+    return q / np.linalg.norm(q)
+
+class SemanticCache:
+    """LRU cache of answers keyed by normalized question embeddings.
+
+    A lookup hits when a cached question has cosine similarity above the
+    threshold. Entries are tagged with a fingerprint of the embedding model and
+    knowledge base version and dropped wholesale when it changes.
+    """
+
+    def __init__(self, max_entries=SEMANTIC_CACHE_MAX_ENTRIES, threshold=SEMANTIC_CACHE_THRESHOLD):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.clock = 0
+        self.fingerprint = None
+        self._clear()
+
+    def _clear(self):
+        # Storage starts empty and doubles as entries are added, up to max_entries
+        self.embeddings = np.zeros((0, EMBEDDING_DIM), dtype=np.float32)
+        self.responses = []
+        self.last_used = np.zeros(0, dtype=np.int64)
+        self.size = 0
+
+    def _grow(self):
+        capacity = min(max(1, 2 * len(self.responses)), self.max_entries)
+        extra = capacity - len(self.responses)
+        self.embeddings = np.vstack([self.embeddings, np.zeros((extra, EMBEDDING_DIM), dtype=np.float32)])
+        self.last_used = np.concatenate([self.last_used, np.zeros(extra, dtype=np.int64)])
+        self.responses += [None] * extra
+
+    def _check_fingerprint(self, fingerprint):
+        if fingerprint != self.fingerprint:
+            self._clear()
+            self.fingerprint = fingerprint
+
+    def get(self, q: np.ndarray, fingerprint: str) -> Optional[QueryResponse]:
+        self._check_fingerprint(fingerprint)
+        if not self.size:
+            return None
+        sims = self.embeddings[:self.size] @ q
+        best = int(np.argmax(sims))
+        if sims[best] < self.threshold:
+            return None
+        self.clock += 1
+        self.last_used[best] = self.clock
+        logger.info(f"Semantic cache hit (similarity {sims[best]:.3f})")
+        return self.responses[best]
+
+    def put(self, q: np.ndarray, fingerprint: str, response: QueryResponse):
+        # An answer computed against a knowledge base that has since been reloaded is dropped
+        if fingerprint != self.fingerprint:
+            return
+        if self.size == len(self.responses) and self.size < self.max_entries:
+            self._grow()
+        if self.size < len(self.responses):
+            slot = self.size
+            self.size += 1
+        else:
+            slot = int(np.argmin(self.last_used))
+        self.clock += 1
+        self.embeddings[slot] = q
+        self.responses[slot] = response
+        self.last_used[slot] = self.clock
+
+semantic_cache = SemanticCache()
+
+def cache_fingerprint(kb: dict) -> str:
+    return f"{EMBEDDING_MODEL}:{kb['version']}"
+
+def retrieve_similar_chunks(q: np.ndarray, kb_tables: dict, top_k=MAX_RESULTS):
+    tables, rows, sims = [], [], []
+    for table, kb in kb_tables.items():
         logger.info(f"Checking {table} for similar chunks...")
-        cursor = conn.execute(f"SELECT url, text, embedding FROM {table}")
-        for url, text, emb_json in cursor.fetchall():
-            try:
-                emb = json.loads(emb_json)
-                if len(emb) != len(question_embedding):
-                    continue
-                similarity = cosine_similarity(question_embedding, emb)
-                if similarity >= SIMILARITY_THRESHOLD:
-                    all_chunks.append({
-                        "source": table.replace("_chunks", ""),
-                        "text": text,
-                        "url": url,
-                        "similarity": similarity,
-                        "post_number": int(url.rstrip("/").split("/")[-1]) if url.rstrip("/").split("/")[-1].isdigit() else 0
-                    })
-            except Exception as e:
-                logger.warning(f"Skipping row → {e}")
-
-    logger.info(f"✅ Retrieved {len(all_chunks)} matching chunks.")
-    return sorted(all_chunks, key=lambda x: (-x["similarity"], -x["post_number"]))[:top_k]
-
-async def generate_llm_answer(question: str, chunks: List[dict], extracted_text: Optional[str] = None) -> str:
+        index = kb["index"]
+        if index is None:
+            continue
+        k = min(top_k, index.get_current_count())
+        index.set_ef(max(HNSW_EF_SEARCH, k))
+        labels, distances = index.knn_query(q, k=k)
+        table_sims = 1 - distances[0]
+        keep = table_sims >= SIMILARITY_THRESHOLD
+        tables += [table] * int(keep.sum())
+        rows.append(labels[0][keep].astype(np.int64))
+        sims.append(table_sims[keep])
+
+    logger.info(f"✅ Retrieved {len(tables)} matching chunks.")
+    if not tables:
+        return []
+
+    rows, sims = np.concatenate(rows), np.concatenate(sims)
+    post_numbers = np.array([kb_tables[t]["post_numbers"][i] for t, i in zip(tables, rows)])
+    # Highest similarity first, newer posts first on ties
+    order = np.lexsort((-post_numbers, -sims))[:top_k]
+    return [
+        {
+            "source": tables[j].replace("_chunks", ""),
+            "text": kb_tables[tables[j]]["texts"][rows[j]],
+            "url": kb_tables[tables[j]]["urls"][rows[j]],
+            "similarity": float(sims[j]),
+            "post_number": int(post_numbers[j]),
+        }
+        for j in order
+    ]
+
+@app.on_event("startup")
+async def open_http_session():
+    # One pooled session for all LLM calls, so connections are kept alive between queries
+    app.state.http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=100, keepalive_timeout=60))
+
+@app.on_event("shutdown")
+async def close_http_session():
+    await app.state.http.close()
+
+async def generate_llm_answer(session: aiohttp.ClientSession, question: str, chunks: List[dict], extracted_text: Optional[str] = None) -> str:
     context = "\n\n".join([
-        f"{chunk['source'].capitalize()} (URL: {chunk['url']}): {chunk['text'][:1500]}"
+        f"{chunk['source'].capitalize()} (URL: {chunk['url']}): {chunk['text']}"
         for chunk in chunks
     ])
 
@@ -143,13 +380,12 @@ Sources:
     }
 
     logger.info("Sending prompt to LLM...")
-    async with aiohttp.ClientSession() as session:
-        async with session.post("https://aipipe.org/openai/v1/chat/completions", headers=headers, json=payload) as resp:
-            if resp.status != 200:
-                logger.error(await resp.text())
-                raise HTTPException(status_code=resp.status, detail=await resp.text())
-            result = await resp.json()
-            return result["choices"][0]["message"]["content"]
+    async with session.post("https://aipipe.org/openai/v1/chat/completions", headers=headers, json=payload) as resp:
+        if resp.status != 200:
+            logger.error(await resp.text())
+            raise HTTPException(status_code=resp.status, detail=await resp.text())
+        result = await resp.json()
+        return result["choices"][0]["message"]["content"]
 
 @app.post("/query", response_model=QueryResponse)
 async def query_virtual_ta(req: QueryRequest, request: Request):
@@ -168,15 +404,29 @@ async def query_virtual_ta(req: QueryRequest, request: Request):
 
     extracted_text = None
     if req.image:
-        extracted_text = extract_text_from_base64_image(req.image)
+        extracted_text = await run_ocr(req.image)
+
+    question_embedding = embed_question(req.question)
+    await refresh_knowledge_base()
+
+    # Answers for image questions depend on the OCR text, so they bypass the cache.
+    # The snapshot and fingerprint are taken once: the KB may be reloaded while the
+    # LLM call is awaited.
+    use_cache = not req.image
+    kb = knowledge_base
+    fingerprint = cache_fingerprint(kb)
+    if use_cache:
+        cached = semantic_cache.get(question_embedding, fingerprint)
+        if cached is not None:
+            return cached
 
-    chunks = retrieve_similar_chunks(req.question)
+    chunks = retrieve_similar_chunks(question_embedding, kb["tables"])
 
     if not chunks:
         logger.warning("No relevant content found for query.")
         return QueryResponse(answer="I couldn't find relevant content.", links=[])
 
-    llm_output = await generate_llm_answer(req.question, chunks, extracted_text)
+    llm_output = await generate_llm_answer(request.app.state.http, req.question, chunks, extracted_text)
 
     if "Sources:" in llm_output:
         answer_part, sources_part = llm_output.split("Sources:", 1)
@@ -188,5 +438,8 @@ async def query_virtual_ta(req: QueryRequest, request: Request):
         url, text = match.groups()
         links.append(Link(url=url.strip(), text=text.strip()))
 
-    return QueryResponse(answer=answer_part.strip(), links=links)
+    response = QueryResponse(answer=answer_part.strip(), links=links)
+    if use_cache:
+        semantic_cache.put(question_embedding, fingerprint, response)
+    return response
 